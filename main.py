@@ -10,7 +10,8 @@ from tic_tac_toe import TicTacToeBoard
 import os, sys, argparse
 import policy
 
-mark_map = {1: " X ", -1: " O ", 0: "   "}
+#marks of -1, 0, 1, indexed by state + 1 to look up the whole board at once
+_MARK = np.array([" O ", "   ", " X "], dtype="<U3")
 
 def render(state):
     """
@@ -21,11 +22,10 @@ def render(state):
             indicating mark of first player, second player, and place not yet occupied.
     """
     clean()
-    h, w = state.shape
-    rows = map(lambda x: "|".join(map(lambda y: mark_map[y], x)), state)
-    splitter = "+".join(["---"] * w)
-    print(("\n" + splitter + "\n").join(rows))
-    print()
+    cells = _MARK[state + 1]
+    rows = ["|".join(row) for row in cells]
+    splitter = "+".join(["---"] * state.shape[1])
+    sys.stdout.write(("\n" + splitter + "\n").join(rows) + "\n\n")
 
 def get_action():
     """
@@ -63,12 +63,10 @@ def set_tie():
 
 def clean():
     """
-    clear screen.
+    clear screen, by writing the ANSI escape sequences of clearing screen and moving cursor to the top left.
     """
-    if sys.platform == "win32":
-        os.system("cls")
-    else:
-        os.system("clear")
+    sys.stdout.write("\x1b[2J\x1b[H")
+    sys.stdout.flush()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="A Tic-TacToe game rendered in Terminal")
@@ -77,6 +75,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
     Agent = getattr(policy, args.policy)
 
+    if sys.platform == "win32":
+        #enable the ANSI escape sequences used by clean() in the Windows console
+        os.system("")
+
     win_len = 3
     board_size = 3, 3 
     board = TicTacToeBoard(board_size, win_len)
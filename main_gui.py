@@ -65,15 +65,22 @@ class TicTacToeGui(QMainWindow):
             self.agent = Agent(-1)
         else:
             self.agent = Agent(1)
+        self.board.agent_marker = self.agent.marker
         self.board.step_finish.connect(self.agent_step)
 
     """
     Automatically step the agent.
+    The move is scheduled on the event loop, so the last move gets painted before the agent decides.
     """
     def agent_step(self, state):
+        if self.agent.marker == self.board.on_move:
+            QtCore.QTimer.singleShot(0, self.agent_move)
+
+    def agent_move(self):
         marker = self.agent.marker
-        if marker == self.board.on_move:
-            self.board.step(marker, self.agent.decide(state))
+        #the game may have been restarted or moved on since it was scheduled
+        if marker == self.board.on_move and not self.board.board.terminated:
+            self.board.step(marker, self.agent.decide(np.copy(self.board.board.board)))
 
     """
     Side Panel, Container for controller.
@@ -150,8 +157,12 @@ class QTicTacToeBoard(QWidget):
 
         self.size = size
         self.board = TicTacToeBoard(size)
+        #the marker of the agent, clicks are ignored on its turns
+        self.agent_marker = None
         #For drawing a line when game finished.
         self.check_cells = []
+        self.line_points = []
+        self.line_pen = None
         self.reset()
 
     def step(self, Policy, position):
@@ -162,6 +173,7 @@ class QTicTacToeBoard(QWidget):
             if info["coordinates"] is not None:
                 for i, j in info["coordinates"]:
                     self.check_cells.append(self.cells[i][j])
+                self._build_line_pixmaps()
             if reward[0] == 1:
                 result_str = "X: Player 1 won!"
             elif reward[0] == -1:
@@ -176,7 +188,10 @@ class QTicTacToeBoard(QWidget):
         self.cells = []
         state, *_ = self.board.reset()
         self.make_cells()        
+        self.synced_board = np.zeros(self.size, dtype=np.int8)
         self.check_cells = []
+        self.line_points = []
+        self.update()
         self.step_finish.emit(state)
 
     @property
@@ -204,52 +219,74 @@ class QTicTacToeBoard(QWidget):
     Synchronize the cell buttons according to the state.
     """
     def sync_cells(self):
-        for i, row in enumerate(self.board.board):
-            for j, cell_val in enumerate(row):
+        #repaint once after all cells are updated
+        self.setUpdatesEnabled(False)
+        try:
+            if self.board.terminated:
+                for row in self.cells:
+                    for cell in row:
+                        cell.setEnabled(False)
+            #only cells changed since the last sync need a new style
+            for i, j in zip(*np.nonzero(self.board.board != self.synced_board)):
                 cell = self.cells[i][j]
-                if self.board.terminated:
-                    cell.setEnabled(False)
-                if cell_val != 0:
-                    if cell_val == 1:
-                        cell.setStyleSheet("border-image: url(./assets_gui/cross.svg) 0 0 0 0 stretch stretch")
-                    else:
-                        cell.setStyleSheet("border-image: url(./assets_gui/circle.svg) 0 0 0 0 stretch stretch")
-                    cell.setEnabled(False)
-                    #cell.style().unpolish(cell)
-                    cell.style().polish(cell)
+                cell.blockSignals(True)
+                if self.board.board[i, j] == 1:
+                    cell.setStyleSheet("border-image: url(./assets_gui/cross.svg) 0 0 0 0 stretch stretch")
+                else:
+                    cell.setStyleSheet("border-image: url(./assets_gui/circle.svg) 0 0 0 0 stretch stretch")
+                cell.blockSignals(False)
+                cell.setEnabled(False)
+                #cell.style().unpolish(cell)
+                cell.style().polish(cell)
+            self.synced_board[:] = self.board.board
+        finally:
+            self.setUpdatesEnabled(True)
+        self.update()
+
+    """
+    Compute the line on cells connected, and cache it on every cell as a pixmap.
+    Called once the game finishes and when resized, so painting only draws the cached results.
+    """
+    def _build_line_pixmaps(self):
+        if len(self.check_cells) <= 2:
+            return
+        points = []
+        for cell in self.check_cells:
+            center = cell.rect().center()
+            location = cell.mapToParent(center)
+            points.append(location)
+        start_offset = (points[0] - points[1])/4
+        end_offset = (points[-1] - points[-2])/4
+        points[0] += start_offset
+        points[-1] += end_offset
+
+        pen = QPen(QColor(150, 100, 100, 150))
+        pen.setWidth(self.width()//27)
+        self.line_points = points
+        self.line_pen = pen
+        for row in self.cells:
+            for cell in row:
+                pixmap = QPixmap(cell.size())
+                pixmap.fill(QColor(0,0,0,0))
+                painter = QPainter(pixmap)
+                painter.setPen(pen)
+                polyline = QPolygon([cell.mapFromParent(point) for point in points])
+                painter.drawPolyline(polyline)
+                painter.end()
+                cell.pixmap = pixmap
+                cell.update()
+        self.update()
+
     """
     Draw lines on cells connected.
     """
     def paintEvent(self, event):
         super().paintEvent(event)
-        if len(self.check_cells) > 2:
-            points = []
-            for cell in self.check_cells:
-                center = cell.rect().center()
-                location = cell.mapToParent(center)
-                points.append(location)
-            start_offset = (points[0] - points[1])/4
-            end_offset = (points[-1] - points[-2])/4
-            points[0] += start_offset
-            points[-1] += end_offset
-
-            pen = QPen(QColor(150, 100, 100, 150))
-            pen.setWidth(self.width()//27)
+        if self.line_points:
             painter = QPainter(self)
-            painter.setPen(pen)
-            polyline = QPolygon(points)
-            painter.drawPolyline(polyline)
+            painter.setPen(self.line_pen)
+            painter.drawPolyline(QPolygon(self.line_points))
             painter.end()
-            for row in self.cells:
-                for cell in row:
-                    pixmap = QPixmap(cell.size())
-                    pixmap.fill(QColor(0,0,0,0))
-                    painter = QPainter(pixmap)
-                    painter.setPen(pen)
-                    polyline = QPolygon([cell.mapFromParent(point) for point in points])
-                    painter.drawPolyline(polyline)
-                    painter.end()
-                    cell.pixmap = pixmap
 
     """
     Maintain the aspect ratio.
@@ -264,6 +301,7 @@ class QTicTacToeBoard(QWidget):
         rect = QRect(0, 0, length, length)
         rect.moveCenter(center)
         self.setGeometry(rect)
+        self._build_line_pixmaps()
 
         
 class Cell(QPushButton):
@@ -276,6 +314,9 @@ class Cell(QPushButton):
         self.pixmap = QPixmap()
 
     def click(self):
+        #the agent's move may still be scheduled, don't play it for the agent
+        if self.board.on_move == self.board.agent_marker:
+            return
         res = self.board.step(self.board.on_move, self.loc)
 
     def paintEvent(self, event):
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-import pickle as pkl
+import functools
 import os.path
+try:
+    from numba import njit
+except ImportError:
+    #numba is optional, it only speeds up training
+    njit = None
 
 class Policy:
     __doc__ = r"""
@@ -10,16 +15,21 @@ class Policy:
     * :attr:`marker` keeps the role of Policy, can either be 1 (for the first Policy),
       or -1 (for the second).
     * :attr:`board_size` keeps the size of the board.
+
+    * :attr:`_rng` the random generator of the Policy.
     
     Args:
         marker (int): either 1 or -1, indicating first Policy or second Policy respectively.
         board_size (int, int): the size of the board.
+        seed (int or numpy.random.SeedSequence, optional): the seed of the random generator,
+            seeded from the OS by default.
     """
 
-    def __init__(self, marker, board_size=(3, 3)):
+    def __init__(self, marker, board_size=(3, 3), seed=None):
         assert marker in [1, -1], "A Policy's marker must be 1 (first) or -1 (second)"
         self.marker = marker
         self.board_size = board_size
+        self._rng = np.random.default_rng(seed)
 
     def decide(self, state):
         """
@@ -35,6 +45,20 @@ class Policy:
         """
         raise NotImplementedError
 
+    def decide_batch(self, states):
+        """
+        Make moves for many states at once. By default it calls :meth:`decide` on every state,
+        Policies may override it with a vectorized version.
+
+        Args:
+            states (ndarray): a 3D numpy array, the game boards stacked along the first axis.
+
+        Returns:
+            actions (ndarray of int): the actions, as indices of the flattened boards.
+        """
+        actions = [self.decide(state) for state in states]
+        return np.array([i * self.board_size[1] + j for i, j in actions], dtype=int)
+
     def get_available_actions(self, state):
         """
         Make move according to the state. It will called by game to get an action.
@@ -44,13 +68,23 @@ class Policy:
                 indicating marker of first Policy, second Policy, and place not yet occupied.
 
         Returns:
-            action ([tuple of (int, int)]): a list of available coordinates to place marker.
+            action (ndarray of int): the available places to place marker, as indices of the flattened board,
+                i.e. the cell (i, j) is i * width + j. Use :meth:`action_to_coord` to get the coordinates back.
         """
         assert state.shape == self.board_size, "Board size mismatch!"
-        empty_x, empty_y = np.where(state == 0) #array of x, and y where the cell at (x_i, y_i) is empty.
-        available_actions = zip(empty_x, empty_y)
-        available_actions = list(available_actions)
-        return available_actions
+        return np.flatnonzero(state.ravel() == 0)
+
+    def action_to_coord(self, idx):
+        """
+        Convert an index of the flattened board to the coordinates.
+
+        Args:
+            idx (int): the index of the flattened board, as given by :meth:`get_available_actions`.
+
+        Returns:
+            action (tuple of (int, int)): the coordinates to place marker.
+        """
+        return divmod(int(idx), self.board_size[1])
 
 
 class RandomPolicy(Policy):
@@ -64,9 +98,10 @@ class RandomPolicy(Policy):
     Args:
         marker (int): either 1 or -1, indicating first Policy or second Policy respectively.
         board_size (int, int): the size of the board.
+        seed (int or numpy.random.SeedSequence, optional): the seed of the random generator.
     """
-    def __init__(self, marker, board_size=(3, 3)):
-        super(RandomPolicy, self).__init__(marker, board_size)
+    def __init__(self, marker, board_size=(3, 3), seed=None):
+        super(RandomPolicy, self).__init__(marker, board_size, seed)
 
     def decide(self, state):
         """
@@ -81,27 +116,176 @@ class RandomPolicy(Policy):
                 starting from 0, i.e. (0, 0) is the top left corner.
         """
         available_actions = self.get_available_actions(state)
-        assert len(available_actions) > 0, "No empty place!"
-        idx = np.random.randint(len(available_actions))
-        return available_actions[idx]
+        assert available_actions.size > 0, "No empty place!"
+        idx = available_actions[self._rng.integers(available_actions.size)]
+        return self.action_to_coord(idx)
+
+#record of a saved entry of QTable, little-endian and packed, 9 bytes each
+_RECORD = np.dtype([("state", "<u4"), ("action", "u1"), ("value", "<f4")])
+
+#the symmetry tables cover all 3 ** cells boards, 12 cells (e.g. 3x4) already take a few hundred MB to build
+_MAX_CELLS = 12
+
+@functools.lru_cache(maxsize=None)
+def _symmetry_tables(board_size):
+    """
+    Map every board of the given size to its canonical form under rotations and reflections.
+
+    A board is encoded as a base-3 number of its cells (shifted from -1, 0, 1 to 0, 1, 2).
+    Among all symmetric images of a board, the one with the smallest code is the canonical form.
+
+    Args:
+        board_size (int, int): the size of the board.
+
+    Returns:
+        row_of (ndarray): for every code, the index of its canonical form among all canonical forms.
+
+        sym_of (ndarray): for every code, which symmetry maps the board to its canonical form.
+
+        columns (ndarray): columns[sym][cell] is where the cell of the board lands in the canonical form.
+
+        empty (ndarray): empty[row][column] tells if the cell of the canonical form is empty.
+    """
+    n_cells = board_size[0] * board_size[1]
+    cells = np.arange(n_cells).reshape(board_size)
+    #canonical[k] = board[perm[k]] for each rotation or reflection keeping the shape of the board
+    perms = [
+        grid.ravel()
+        for k in range(4)
+        for grid in (np.rot90(cells, k), np.fliplr(np.rot90(cells, k)))
+        if grid.shape == cells.shape
+    ]
+    perms = np.unique(perms, axis=0)
+
+    pow3 = 3 ** np.arange(n_cells, dtype=np.int64)
+    digits = np.arange(3 ** n_cells, dtype=np.int64)[:, None] // pow3 % 3
+    codes = digits[:, perms].dot(pow3)
+    sym_of = codes.argmin(-1)
+    canonical_codes = codes[np.arange(len(codes)), sym_of]
+    canonical_codes, row_of = np.unique(canonical_codes, return_inverse=True)
+    empty = canonical_codes[:, None] // pow3 % 3 == 1
+
+    #the tables have a fixed size, 3 ** cells entries, so keep them in the smallest dtypes to stay in cache
+    row_of = row_of.astype(np.min_scalar_type(len(canonical_codes) - 1))
+    sym_of = sym_of.astype(np.uint8)
+    columns = np.argsort(perms, -1).astype(np.min_scalar_type(n_cells - 1))
+    tables = row_of, sym_of, columns, empty
+    for table in tables:
+        #shared by every QTable of the same board size
+        table.setflags(write=False)
+    return tables
+
+if njit is not None:
+    @njit(cache=True)
+    def _batch_deltas(table, empty, state_codes, action_codes, rewards, next_codes, alpha, gamma):
+        """
+        Compiled changes of the Q-values of a batch of transactions, the same as the vectorized ones in
+        :meth:`QLearningPolicy.flush_transactions`.
+        """
+        deltas = np.empty(state_codes.size)
+        for i in range(state_codes.size):
+            # Compute max Q-value for next state over the empty cells, 0 for terminal state
+            max_next_q = 0.0
+            if next_codes[i] >= 0:
+                max_next_q = -np.inf
+                for j in range(table.shape[1]):
+                    if empty[next_codes[i], j] and table[next_codes[i], j] > max_next_q:
+                        max_next_q = table[next_codes[i], j]
+            current_q = table[state_codes[i], action_codes[i]]
+            deltas[i] = alpha * (rewards[i] + gamma * max_next_q - current_q)
+        return deltas
 
 class QTable:
     __doc__ = r"""
     A Q table class, to simplify looking up and setting value of a q table. 
 
+    The table is dense and reduced by the symmetry of the board: all boards equivalent under
+    rotations and reflections share one row, and the columns of that row follow the cells of the canonical form.
+    E.g. on a 3x3 board, the 19683 possible boards collapse into 2862 rows.
+    So it only supports boards of at most 12 cells.
+
     * :attr:`default_val` keeps the default value.
-    * :attr:`_encode_state` helper function to convert state to an unique code of state.
+    * :attr:`_encode_action` helper function to convert action to its index of the flattened board.
+
+    * :attr:`table` keeps the actual table, a float32 ndarray of shape (rows, cells).
 
-    * :attr:`table` keeps the actual table.
+    * :attr:`empty` a bool ndarray of the same shape, tells if the cell of a column is empty, i.e. a valid action.
+
+    * :attr:`greedy_cache` a dict maps a row to the column of its greedy action.
+      Setting a value or loading drops the affected entries, code writing :attr:`table` directly has to drop them itself.
     
     Args:
         default_val (float): the default value for an unseen pair of state and action.
+        board_size (int, int): the size of the board.
     """
-    def __init__(self, default_val):
-        #using a two layer dictionary with with a default value as the q table
-        self.table = {}
-        self._encode_state = lambda x: x.astype("b").tobytes()
+    def __init__(self, default_val, board_size=(3, 3)):
+        assert board_size[0] * board_size[1] <= _MAX_CELLS, \
+            "QTable supports boards of at most {} cells, got {}x{}!".format(_MAX_CELLS, *board_size)
+        self._row_of, self._sym_of, self._columns, self.empty = _symmetry_tables(tuple(board_size))
+        self.table = np.full(self.empty.shape, default_val, dtype=np.float32)
+        self._pow3 = 3 ** np.arange(self.table.shape[1], dtype=np.int64)
+        #sum((x + 1) * 3 ** k) == sum(x * 3 ** k) + sum(3 ** k), so encoding needs no shifted copy of the state
+        self._code_offset = int(self._pow3.sum())
+        self._encode_action = lambda a: a[0] * board_size[1] + a[1]
         self.default_val = default_val
+        self.greedy_cache = {}
+
+    def encode(self, state):
+        """
+        Convert state to an unique code of its canonical form, i.e. its row in the table.
+        Encode a state once and pass the code to :meth:`get_row` to avoid re-encoding.
+
+        Args:
+            state (ndarray): the game board.
+
+        Returns:
+            state_code (int): the code of state.
+
+            columns (ndarray): columns[idx] is the column of the action at index idx of the flattened board.
+        """
+        return self.encode_key(int(state.ravel().dot(self._pow3)) + self._code_offset)
+
+    def encode_key(self, state_key):
+        """
+        The same as :meth:`encode`, from the base-3 code of the board instead,
+        i.e. the sum of (state[i, j] + 1) * 3 ** (i * width + j), as kept by TicTacToeBoard.state_key.
+
+        Args:
+            state_key (int): the base-3 code of the board.
+
+        Returns:
+            state_code (int): the code of state.
+
+            columns (ndarray): columns[idx] is the column of the action at index idx of the flattened board.
+        """
+        return int(self._row_of[state_key]), self._columns[self._sym_of[state_key]]
+
+    def encode_batch(self, states):
+        """
+        Convert many states to the codes of their canonical forms at once, see :meth:`encode`.
+
+        Args:
+            states (ndarray): the game boards stacked along the first axis.
+
+        Returns:
+            state_codes (ndarray): the codes of states.
+
+            columns (ndarray): columns[k][idx] is the column of the action at index idx of the k-th flattened board.
+        """
+        codes = states.reshape(len(states), -1).dot(self._pow3) + self._code_offset
+        return self._row_of[codes], self._columns[self._sym_of[codes]]
+
+    def get_row(self, state_code):
+        """
+        Look up Q(state, ·) of all actions by an encoded state.
+
+        Args:
+            state_code (int): the code of state, given by :meth:`encode`.
+
+        Returns:
+            row (ndarray): a view of the row, indexed by the columns given by :meth:`encode`.
+        """
+        return self.table[state_code]
 
     def __getitem__(self, key):
         """
@@ -113,12 +297,8 @@ class QTable:
         """
         assert len(key) == 2, "It's not a valid key!"
         state, action = key
-        state_code = self._encode_state(state)
-        if state_code not in self.table:
-            self.table[state_code] = {}
-        if action not in self.table[state_code]:
-            self.table[state_code][action] = self.default_val
-        return self.table[state_code][action]
+        state_code, columns = self.encode(state)
+        return self.table[state_code, columns[self._encode_action(action)]]
 
     def __setitem__(self, key, val):
         """
@@ -131,28 +311,39 @@ class QTable:
         """
         assert len(key) == 2, "It's not a valid key!"
         state, action = key
-        state_code = self._encode_state(state)
-        self.table[state_code][action] = val
+        state_code, columns = self.encode(state)
+        self.table[state_code, columns[self._encode_action(action)]] = val
+        self.greedy_cache.pop(state_code, None)
 
     def load(self, name):
         """
         Load saved table.
 
         Args:
-            name (str): name of the pickle file saves the table,
+            name (str): name of the binary file saves the table,
         """
         with open(name, "rb") as f:
-            self.table = pkl.load(f)
+            records = np.fromfile(f, dtype=_RECORD)
+        assert records.size == 0 or (
+            records["state"].max() < self.table.shape[0] and records["action"].max() < self.table.shape[1]
+        ), "Saved table doesn't match the board size!"
+        self.table[:] = self.default_val
+        self.table[records["state"], records["action"]] = records["value"]
+        self.greedy_cache.clear()
 
     def save(self, name=None):
         """
-        Save table to pickle file.
+        Save table to binary file, as fixed-width records of (state, action, value)
+        for every entry differing from the default value.
 
         Args:
-            name (str): name of the pickle file saves the table,
+            name (str): name of the binary file saves the table,
         """
+        states, actions = np.nonzero(self.table != self.default_val)
+        records = np.empty(states.size, dtype=_RECORD)
+        records["state"], records["action"], records["value"] = states, actions, self.table[states, actions]
         with open(name, "wb") as f:
-            pkl.dump(self.table, f)
+            records.tofile(f)
 
 class QLearningPolicy(Policy):
     __doc__ = r"""
@@ -179,11 +370,15 @@ class QLearningPolicy(Policy):
         marker (int): either 1 or -1, indicating first Policy or second Policy respectively.
         board_size (int, int): the size of the board.
 
+        seed (int or numpy.random.SeedSequence, optional): the seed of the random generator.
+
+        autoload (bool, optional): whether to load the saved table if any, default to be True.
+
         ... (any, optional): You can add additional optional arguments,
             but ensure it works in main\*.py without changing them
     """
-    def __init__(self, marker, board_size=(3, 3)):
-        super(QLearningPolicy, self).__init__(marker, board_size)
+    def __init__(self, marker, board_size=(3, 3), seed=None, autoload=True):
+        super(QLearningPolicy, self).__init__(marker, board_size, seed)
 
         initial_val = 0 #The default value for every unseen state, action pair.
 
@@ -193,13 +388,14 @@ class QLearningPolicy(Policy):
         self.epsilon = 0.1  # Exploration rate (for epsilon-greedy)
         
         
-        self.q_table = QTable(initial_val)
+        self.q_table = QTable(initial_val, board_size)
+        self.transactions = [] #transactions stored for a batch update
         self.mode = "eval"
         # self.mode = "train"
 
         #load if any save exists
         name = "q_table_player" + ("1" if marker == 1 else "2")
-        if os.path.exists(name):
+        if autoload and os.path.exists(name):
             self.load()
 
     def load(self, name=None):
@@ -207,7 +403,7 @@ class QLearningPolicy(Policy):
         load saved table.
 
         Args:
-            name (str, optional): name of the pickle file saves the table,
+            name (str, optional): name of the binary file saves the table,
                 default to be q_table_player1 (marker == 1) or q_table_player2 (marker == -1)
         """
         if not name:
@@ -217,10 +413,10 @@ class QLearningPolicy(Policy):
 
     def save(self, name=None):
         """
-        save table to pickle file.
+        save table to binary file.
 
         Args:
-            name (str, optional): name of the pickle file saves the table,
+            name (str, optional): name of the binary file saves the table,
                 default to be q_table_player1 (marker == 1) or q_table_player2 (marker == -1)
         """
         if not name:
@@ -231,7 +427,7 @@ class QLearningPolicy(Policy):
         assert mode in ["train", "eval"]
         self.mode = mode
 
-    def decide(self, state):
+    def decide(self, state, state_key=None):
         """
         decide action according to the state and current mode.
         YOU NEED TO FINISH IT
@@ -240,27 +436,59 @@ class QLearningPolicy(Policy):
             state (ndarray): a 2D numpy array, the game board, filled with 1, -1, 0,
                 indicating marker of first Policy, second Policy, and place not yet occupied.
 
+            state_key (int, optional): the base-3 code of the state, e.g. TicTacToeBoard.state_key,
+                saves encoding the state again.
+
         Returns:
             action (tuple of (int, int)): indicates the coordinates to place marker,
                 starting from 0, i.e. (0, 0) is the top left corner.        
         """
         available_actions = self.get_available_actions(state)
-        move = available_actions[0]
 
         # Decide what action to take given current state and mode using the q table.
         # directly loop up the value of Q(state, action) with self.q_table[state, action].
-        if self.mode == "train" and np.random.rand() < self.epsilon:
+        if self.mode == "train" and self._rng.random() < self.epsilon:
             # Exploration: Random action
-            import random  # Use Python's random.choice for lists of tuples
-            return random.choice(available_actions)
+            move = available_actions[self._rng.integers(available_actions.size)]
         else:
-            # Exploitation: Choose action with highest Q-value
-            move = max(
-                available_actions,
-                key=lambda action: self.q_table[state, action]
-            )
+            # Exploitation: Choose action with highest Q-value, gathering the whole row at once
+            if state_key is None:
+                state_code, columns = self.q_table.encode(state)
+            else:
+                state_code, columns = self.q_table.encode_key(state_key)
+            greedy_column = self.q_table.greedy_cache.get(state_code)
+            if greedy_column is not None:
+                move = available_actions[columns[available_actions] == greedy_column][0]
+            else:
+                qs = self.q_table.get_row(state_code)[columns[available_actions]]
+                move = available_actions[qs.argmax()]
+                self.q_table.greedy_cache[state_code] = columns[move]
+
+        return self.action_to_coord(move)
+
+    def decide_batch(self, states):
+        """
+        decide actions for many states at once, in the same way as :meth:`decide`.
 
-        return move
+        Args:
+            states (ndarray): a 3D numpy array, the game boards stacked along the first axis.
+
+        Returns:
+            actions (ndarray of int): the actions, as indices of the flattened boards.
+        """
+        available = states.reshape(len(states), -1) == 0
+        assert available.any(-1).all(), "No empty place!"
+
+        # Exploitation: Choose action with highest Q-value, the first one in case of a tie
+        state_codes, columns = self.q_table.encode_batch(states)
+        qs = np.take_along_axis(self.q_table.table[state_codes], columns, -1)
+        actions = np.where(available, qs, -np.inf).argmax(-1)
+        if self.mode == "train":
+            # Exploration: Random action, drawn by the largest random key among the empty cells
+            explore = self._rng.random(len(states)) < self.epsilon
+            keys = np.where(available[explore], self._rng.random(available[explore].shape), -1)
+            actions[explore] = keys.argmax(-1)
+        return actions
 
     def update_q_table(self, state, action, reward, next_state):
         """
@@ -285,16 +513,119 @@ class QLearningPolicy(Policy):
         # Update the table given a transaction tuple.
         # directly set the value Q(state, action) to val with self.q_table[state, action] = val.
 
+        # Encode the states once, then look up by code
+        state_code, columns = self.q_table.encode(state)
+        action_code = columns[self.q_table._encode_action(action)]
+
         # Get current Q-value
-        current_q = self.q_table[state, action]
+        row = self.q_table.get_row(state_code)
+        current_q = row[action_code]
 
         # Compute max Q-value for next state
-        max_next_q = 0 if next_state is None else max(
-            self.q_table[next_state, a] for a in self.get_available_actions(next_state)
-        )
+        if next_state is None:
+            max_next_q = 0
+        else:
+            # the empty cells of the canonical form are the available actions, already in column order
+            next_code, _ = self.q_table.encode(next_state)
+            max_next_q = self.q_table.get_row(next_code)[self.q_table.empty[next_code]].max()
 
         # Update Q-value using Q-learning formula
-        new_q = current_q + self.alpha * (reward + self.gamma * max_next_q - current_q)
-        self.q_table[state, action] = new_q
+        row[action_code] = current_q + self.alpha * (reward + self.gamma * max_next_q - current_q)
+        self.q_table.greedy_cache.pop(state_code, None)
 
-        
+    def store_transaction(self, state, action, reward, next_state):
+        """
+        Store a transaction tuple of (state, action, reward, next_state), to update the q_table in batch
+        with :meth:`flush_transactions`, e.g. once a game ends. Takes the same arguments as :meth:`update_q_table`.
+        """
+        assert self.mode == "train", "Q table should not be updated during evaluation!"
+        state_code, columns = self.q_table.encode(state)
+        action_code = columns[self.q_table._encode_action(action)]
+        #code -1 marks a terminal next state
+        next_code = -1 if next_state is None else self.q_table.encode(next_state)[0]
+        self.transactions.append((state_code, action_code, reward, next_code))
+
+    def store_transactions(self, states, actions, rewards, next_states=None, terminated=None):
+        """
+        Store many transaction tuples at once, see :meth:`store_transaction`.
+
+        Args:
+            states (ndarray): a 3D numpy array, the game boards before the actions were taken.
+
+            actions (ndarray of int): the actions, as indices of the flattened boards.
+
+            rewards (ndarray of float): the rewards of the transactions.
+
+            next_states (ndarray or NoneType): a 3D numpy array, the game boards after the actions and opponent's
+                responses, or None if all of them are terminal states.
+
+            terminated (ndarray of bool, optional): tells which of next_states are terminal states.
+        """
+        assert self.mode == "train", "Q table should not be updated during evaluation!"
+        state_codes, columns = self.q_table.encode_batch(states)
+        action_codes = np.take_along_axis(columns, actions[:, None], -1)[:, 0]
+        #code -1 marks a terminal next state
+        if next_states is None:
+            next_codes = np.full(len(states), -1)
+        else:
+            next_codes, _ = self.q_table.encode_batch(next_states)
+            if terminated is not None:
+                next_codes = np.where(terminated, -1, next_codes.astype(np.int64))
+        self.transactions.extend(
+            zip(state_codes.tolist(), action_codes.tolist(), np.asarray(rewards).tolist(), next_codes.tolist())
+        )
+
+    def flush_transactions(self):
+        """
+        Update the q_table with all stored transactions at once, using the same Q-learning formula
+        as :meth:`update_q_table`. All targets are computed before any write, so the deltas of a pair of
+        state and action stored several times are averaged, summing them would overshoot.
+        """
+        if not self.transactions:
+            return
+        state_codes, action_codes, rewards, next_codes = (
+            np.array(column, dtype=dtype)
+            for column, dtype in zip(zip(*self.transactions), (np.int64, np.int64, np.float64, np.int64))
+        )
+        #a game stores every pair once, only batches of games need averaging
+        repeated = len({transaction[:2] for transaction in self.transactions}) < len(self.transactions)
+        self.transactions = []
+        table = self.q_table.table
+
+        if njit is not None:
+            deltas = _batch_deltas(
+                table, self.q_table.empty, state_codes, action_codes, rewards, next_codes, self.alpha, self.gamma
+            )
+        else:
+            # Compute max Q-value for next states over the empty cells, 0 for terminal states
+            max_next_q = np.where(self.q_table.empty[next_codes], table[next_codes], -np.inf).max(-1)
+            max_next_q[next_codes < 0] = 0
+
+            # Q-learning formula
+            current_q = table[state_codes, action_codes]
+            deltas = self.alpha * (rewards + self.gamma * max_next_q - current_q)
+
+        self.add_to_q_table(state_codes, action_codes, deltas, average=repeated)
+
+    def add_to_q_table(self, state_codes, action_codes, deltas, average=False):
+        """
+        Add deltas to the Q-values of encoded states and actions, e.g. to merge the updates made by another copy
+        of the policy. Repeated pairs of state and action are accumulated, or averaged if average is True.
+
+        Args:
+            state_codes (ndarray of int): the codes of states, given by :meth:`QTable.encode`.
+
+            action_codes (ndarray of int): the columns of actions in the rows.
+
+            deltas (ndarray of float): the values to add.
+
+            average (bool, optional): whether to add the average of the deltas of repeated pairs instead of their sum.
+        """
+        if average:
+            n_cols = self.q_table.table.shape[1]
+            keys, inverse, counts = np.unique(state_codes * n_cols + action_codes, return_inverse=True, return_counts=True)
+            state_codes, action_codes = np.divmod(keys, n_cols)
+            deltas = np.bincount(inverse, weights=deltas) / counts
+        np.add.at(self.q_table.table, (state_codes, action_codes), deltas)
+        for state_code in state_codes.tolist():
+            self.q_table.greedy_cache.pop(state_code, None)
@@ -1,27 +1,77 @@
 # -*- coding: utf-8 -*-
 import numpy as np
+import functools
 
-def np_conv2d(x, ker):
+@functools.lru_cache(maxsize=None)
+def _line_tables(size, length):
     """
-    calculate the 2d convolution of x and y.
-    
+    Build what it takes to find lines of the given length on the board.
+    They depend on the size and the length only, so boards of the same size and length share them.
+
     Args:
-        x (2d numpy array): the input.
-        ker (2d numpy array): the kernel.
+        size (tuple of (int, int)): the size of the board.
+
+        length (int): the length of a line.
 
     Return:
-        out (2d numpy array): the valid convolution result.
+        masks (tuple of int): the bitmasks, one for each line.
+            The cell (i, j) is the bit i * width + j.
+
+        masks_through (tuple of tuple of int): for each cell of the flattened board, the masks of the lines through it.
+
+        kernels_bases (tuple of 2d numpy array): coordinates of the cells of a horizontal, vertical,
+            diagonal and antidiagonal line starting from (0, 0) respectively.
     """
-    sliding_windows = np.lib.stride_tricks.sliding_window_view(x, ker.shape)
-    out = sliding_windows.reshape(*sliding_windows.shape[:2], -1).dot(
-        ker.flatten()
+    h, w = size
+    kernels_bases = (
+        np.array([(0, k) for k in range(length)]), #cells of a horizontal line
+        np.array([(k, 0) for k in range(length)]), #cells of a vertical line
+        np.array([(k, k) for k in range(length)]), #cells of a diagonal line
+        np.array([(k, length - 1 - k) for k in range(length)]), #cells of a antidiagonal line
     )
-    return out
+    masks = []
+    for bases in kernels_bases:
+        for i in range(h - bases[:, 0].max()):
+            for j in range(w - bases[:, 1].max()):
+                masks.append(sum(1 << int((k + i) * w + l + j) for k, l in bases))
+    masks_through = tuple(tuple(mask for mask in masks if mask >> cell & 1) for cell in range(h * w))
+    for table in kernels_bases:
+        table.setflags(write=False)
+    return tuple(masks), masks_through, kernels_bases
+
+def find_winners(boards, length):
+    """
+    Find the winner of many boards at once, e.g. to play many games side by side.
+
+    Args:
+        boards (3d numpy array): the game boards stacked along the first axis,
+            filled with 1 (for first player), -1 (for second player), 0 (empty cell).
+
+        length (int): the length of a line.
+
+    Return:
+        winners (1d numpy array): for each board, 1 if the first player has a line,
+            -1 if the second player has a line, or 0 if there is no line.
+    """
+    h, w = boards.shape[1:]
+    *_, kernels_bases = _line_tables((h, w), length)
+    p1_win = np.zeros(len(boards), dtype=bool)
+    p2_win = np.zeros(len(boards), dtype=bool)
+    for bases in kernels_bases:
+        #sum the cells of every line on every board, with one shifted slice for each cell
+        n_rows, n_cols = h - bases[:, 0].max(), w - bases[:, 1].max()
+        if n_rows <= 0 or n_cols <= 0:
+            continue
+        sums = sum(boards[:, i:i + n_rows, j:j + n_cols] for i, j in bases).reshape(len(boards), -1)
+        p1_win |= (sums == length).any(-1)
+        p2_win |= (sums == -length).any(-1)
+    assert not (p1_win & p2_win).any(), "Something impossible happened!"
+    return p1_win.astype(np.int8) - p2_win.astype(np.int8)
 
 class TicTacToeBoard:
     __doc__ = r"""
     A game board for tic-tac-toe.
-    * :attr:`board` a two dimensional numpy array of type int.
+    * :attr:`board` a two dimensional numpy array of type int8.
       It contains only 1 (for first player), -1 (for second player), 0 (empty cell).
 
     * :attr:`counter` a int records how many steps have been taken in total.
@@ -33,6 +83,16 @@ class TicTacToeBoard:
     * :attr:`terminated` indicates whether the game ends in "terminate".
 
     * :attr:`win_len` indicates the number of markers the corresponding player required to place in a line to win
+
+    * :attr:`state_key` a int code of the board, the sum of (board[i, j] + 1) * 3 ** (i * width + j).
+      It is the code QTable encodes the board to, kept up to date by every step.
+      It is updated from the same checked cell as the board, and a rejected step changes neither.
+
+    The state given by :meth:`reset` and :meth:`step` is a read-only view of :attr:`board`, not a copy,
+    so it changes with the following steps. Copy it to keep the board as it was.
+
+    The board is mirrored by two bitboards, one int for each player with the bit i * width + j set
+    when the player has a marker on (i, j), so lines are checked with a few integer operations.
     
     Args:
         size (tuple of (int, int), optional): The size of the game board, default to be (3, 3)
@@ -41,17 +101,32 @@ class TicTacToeBoard:
                 default to be `min(size)`
     """
     def __init__(self, size=(3, 3), length=None):
-        self.board = np.zeros(size, dtype=int)
+        self.board = np.zeros(size, dtype=np.int8)
         self.win_len = length if length else min(size)
+        self._win_masks, self._masks_through, self._kernels_bases = _line_tables(self.board.shape, self.win_len)
+        self._full_mask = (1 << self.board.size) - 1
+        self._state = self.board.view()
+        self._state.setflags(write=False)
+        self._p1_bb = 0
+        self._p2_bb = 0
+        self._pow3 = tuple(3 ** k for k in range(self.board.size))
+        #every cell is empty, i.e. the digit 1
+        self._empty_key = sum(self._pow3)
+        self.state_key = self._empty_key
         self.counter = 0
         self.on_move = 1
         self.terminated = False
 
-    def _check_board(self):
+    def _check_board(self, last_move=None):
         """
         Check the status of the board to find if any player places 
         the corresponding marker in a line of length specified.
 
+        Args:
+            last_move (tuple of (int, int), optional): the position of the last marker placed.
+                A new line has to pass through it, so only those lines are checked, for its player only.
+                Check every line of both players if not given.
+
         Returns:
             winner (int): can be 1 indicating the first player won,
                 -1 indicating the second player won,
@@ -63,52 +138,46 @@ class TicTacToeBoard:
                 The value is None when there is no winner.
         """
         length = self.win_len
-        # check if board only contains -1, 0, 1
-        assert all(
-            map(lambda x: x in [-1, 0, 1], np.unique(self.board))
-        ), "Something impossible happened!"
-
-        # check consecutive 1 or -1 using 2d convolution
-        ker_horizontal, ker_diagonal = np.ones((1, length)), np.eye(length) #kernel for checking horizonally and diagonally
-        ker_vertical, ker_antidiagonal = np.rot90(ker_horizontal), np.rot90(ker_diagonal) #kernel for checking vertically and antidiagonally
-        kernels = [ker_horizontal, ker_vertical, ker_diagonal, ker_antidiagonal]
-        kernels_bases = []
-        for ker in kernels:
-            #coordinates of 1s in the kernel
-            kernels_bases.append(np.stack(np.where(ker == 1), -1))
-
-        checks = [np_conv2d(self.board, ker) for ker in kernels]
-        p1_coordinates = []
-        #Find coordinates of marker 1 forming lines
-        for check, bases in zip(checks, kernels_bases):
-            offsets = np.stack(np.where(check == length), -1)
-            coords = offsets[:, None] + bases
-            coords = coords.reshape(-1, coords.shape[-1])
-            p1_coordinates.append(coords)
-        p1_coordinates = np.concatenate(p1_coordinates)
-        p1_win = len(p1_coordinates) > 0
-
-        #Find coordinates of marker -1 forming lines
-        p2_coordinates = []
-        for check, bases in zip(checks, kernels_bases):
-            offsets = np.stack(np.where(check == -length), -1)
-            coords = offsets[:, None] + bases
-            coords = coords.reshape(-1, coords.shape[-1])
-            p2_coordinates.append(coords)
-        p2_coordinates = np.concatenate(p2_coordinates)
-        p2_win = len(p2_coordinates) > 0
-
-        assert p1_win != p2_win or p1_win == 0, "Something impossible happened!"
-        terminated = p1_win or p2_win or np.all(self.board != 0)
-        if p1_win:
-            return 1, terminated, p1_coordinates
-        if p2_win:
-            winner = -1
-            coordinates = p2_coordinates
+        p1_bb, p2_bb = self._p1_bb, self._p2_bb
+        #the board is full once every cell has a marker
+        full = (p1_bb | p2_bb) == self._full_mask
+        #a line needs at least 2 * length - 1 markers on the board, length of them from the first player
+        if self.counter < 2 * length - 1:
+            return 0, full, None
+
+        # check for a line on the bitboards
+        if last_move is not None:
+            cell = int(last_move[0] * self.board.shape[1] + last_move[1])
+            winner = int(self.board[last_move])
+            bb = p1_bb if winner == 1 else p2_bb
+            if not any(bb & mask == mask for mask in self._masks_through[cell]):
+                return 0, full, None
         else:
-            winner = 0
-            coordinates = None
-        return winner, terminated, coordinates
+            p1_win = any(p1_bb & mask == mask for mask in self._win_masks)
+            p2_win = any(p2_bb & mask == mask for mask in self._win_masks)
+            assert not (p1_win and p2_win), "Something impossible happened!"
+            if not (p1_win or p2_win):
+                return 0, full, None
+            winner = 1 if p1_win else -1
+
+        # find the coordinates of the markers forming lines, only once someone won
+        h, w = self.board.shape
+        #horizontal and vertical lines are box filters, sum them by differences of running sums starting from 0
+        row_sums = np.zeros((h, w + 1), dtype=int)
+        col_sums = np.zeros((h + 1, w), dtype=int)
+        np.cumsum(self.board, axis=1, out=row_sums[:, 1:])
+        np.cumsum(self.board, axis=0, out=col_sums[1:])
+        line_sums = [row_sums[:, length:] - row_sums[:, :-length], col_sums[length:] - col_sums[:-length]]
+        for bases in self._kernels_bases[2:]:
+            #sum the cells of every diagonal line directly, with one shifted slice for each cell
+            n_rows, n_cols = max(h - bases[:, 0].max(), 0), max(w - bases[:, 1].max(), 0)
+            line_sums.append(sum(self.board[i:i + n_rows, j:j + n_cols] for i, j in bases))
+        coordinates = []
+        for bases, sums in zip(self._kernels_bases, line_sums):
+            offsets = np.argwhere(sums == winner * length)
+            coords = offsets[:, None] + bases
+            coordinates.append(coords.reshape(-1, coords.shape[-1]))
+        return winner, True, np.concatenate(coordinates)
 
 
     def reset(self):
@@ -116,7 +185,7 @@ class TicTacToeBoard:
         Reset the game board.
 
         Returns:
-            state (ndarray): the game board, represented in 2d numpy array of type int.
+            state (ndarray): the game board, represented in 2d numpy array of type int8, as a read-only view.
                 It contains only 1 (for first player), -1 (for second player), 0 (empty cell).
 
             info (dict): a dict keeps who should make move now as "on_move", and the connected markers' coordinates as "coordinates" 
@@ -128,10 +197,13 @@ class TicTacToeBoard:
         """
         self.counter = 0
         self.board[:] = 0
+        self._p1_bb = 0
+        self._p2_bb = 0
+        self.state_key = self._empty_key
         self.on_move = 1
         self.terminated = False
         info = {"on_move": self.on_move, "coordinates": None}
-        return np.copy(self.board), info
+        return self._state, info
 
     def step(self, player, position):
         """
@@ -141,10 +213,10 @@ class TicTacToeBoard:
             player (int): can either be 1 indicating the first player or -1 indicating the second.
 
             position (tuple of (int, int)): the coordinates of the position to place the marker.
-                Starting from 0.
+                Starting from 0, negative coordinates count from the end as in numpy indexing.
 
         Returns:
-            state (ndarray): the game board, represented in 2d numpy array of type int.
+            state (ndarray): the game board, represented in 2d numpy array of type int8, as a read-only view.
                 It contains only 1 (for first player), -1 (for second player), 0 (empty cell).
 
             reward (tuple of (float, float)): the rewards for the first player and the second player,
@@ -160,14 +232,25 @@ class TicTacToeBoard:
                 The value is None when there is no winner.
         """
         assert player == self.on_move, "Not this player's turn!"
+        h, w = self.board.shape
+        assert -h <= position[0] < h and -w <= position[1] < w, "Position out of the board!"
+        #wrap negative coordinates as numpy indexing does, so the board and the bitboards agree on the cell
+        position = (int(position[0]) % h, int(position[1]) % w)
         assert self.board[position] == 0, "Position already occupied!"
         #set the marker
+        cell = position[0] * w + position[1]
         self.board[position] = player
+        self.state_key += player * self._pow3[cell]
+        bit = 1 << cell
+        if player == 1:
+            self._p1_bb |= bit
+        else:
+            self._p2_bb |= bit
 
         #update counter
         self.counter += 1
         #get reward of 1 if win or -1 if lose and 0 if tie
-        p1_reward, terminated, coordinates = self._check_board()
+        p1_reward, terminated, coordinates = self._check_board(position)
         p2_reward = -p1_reward
         reward = (p1_reward, p2_reward)
 
@@ -176,6 +259,6 @@ class TicTacToeBoard:
         self.terminated = terminated
 
         info = {"on_move": self.on_move, "coordinates": coordinates}
-        return np.copy(self.board), reward, terminated, info
+        return self._state, reward, terminated, info
 
 
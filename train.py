@@ -2,11 +2,20 @@
 __doc__ = """This is a script for training Q-Learning Agent"""
 
 import numpy as np
-from tic_tac_toe import TicTacToeBoard
+from tic_tac_toe import TicTacToeBoard, find_winners
 from policy import QLearningPolicy, RandomPolicy
-import matplotlib.pyplot as plt
+from multiprocessing import shared_memory, resource_tracker
+import multiprocessing
 import argparse
 
+def _decider(policy, board):
+    """
+    Give the decide function of policy on board, passing the code the board keeps for the state to QLearningPolicy.
+    """
+    if isinstance(policy, QLearningPolicy):
+        return lambda state: policy.decide(state, board.state_key)
+    return policy.decide
+
 def run_test(board, policy1, policy2):
     """
     Run the game between policy1 and policy2 till someone win or tie.
@@ -24,13 +33,14 @@ def run_test(board, policy1, policy2):
             or 0, means tie.
     """
     p1_state, info = board.reset()
+    decide1, decide2 = _decider(policy1, board), _decider(policy2, board)
     while True:
         if info["on_move"] == 1:
-            action = policy1.decide(p1_state)
+            action = decide1(p1_state)
             p2_state, (p1_reward, p2_reward), terminated, info = board.step(1, action)
 
         elif info["on_move"] == -1:
-            action = policy2.decide(p2_state)
+            action = decide2(p2_state)
             p1_state, (p1_reward, p2_reward), terminated, info = board.step(-1, action)
 
         if terminated:
@@ -55,130 +65,344 @@ def run_train(board, policy1, policy2):
             -1 indicating the second Policy won,
             or 0, means tie.
     """
-    p1_state, info = board.reset()
+    p1_state, _ = board.reset()
     train_p1 = isinstance(policy1, QLearningPolicy) and policy1.mode == "train"
     train_p2 = isinstance(policy2, QLearningPolicy) and policy2.mode == "train"
+    decide1, decide2 = _decider(policy1, board), _decider(policy2, board)
+    store1 = policy1.store_transaction if train_p1 else None
+    store2 = policy2.store_transaction if train_p2 else None
+    step = board.step
+
+    #the last (state, action, reward) of each player, waiting for the response of the opponent
+    transaction_p1 = transaction_p2 = None
+    transaction_p1_valid = transaction_p2_valid = False
+    #the players take turns from policy1, so each round is a move of policy1 then a move of policy2
+    while True:
+        action = decide1(p1_state)
+        if train_p1:
+            #the state is a view of the board, keep it as it was before the move
+            p1_state = p1_state.copy()
+        p2_state, (p1_reward, p2_reward), terminated, _ = step(1, action)
+
+        #train policy2 and there is a state before p2_state for policy2
+        if transaction_p2_valid:
+            #add the reward for policy2 caused by policy1,
+            #if policy1 makes it terminated, the p2_state is a terminal state for policy2
+            state, prev_action, reward = transaction_p2
+            store2(state, prev_action, reward + p2_reward, None if terminated else p2_state)
+        if train_p1:
+            transaction_p1, transaction_p1_valid = (p1_state, action, p1_reward), True
+            if terminated:
+                store1(p1_state, action, p1_reward, None)
+        if terminated:
+            break
+
+        action = decide2(p2_state)
+        if train_p2:
+            #the state is a view of the board, keep it as it was before the move
+            p2_state = p2_state.copy()
+        p1_state, (p1_reward, p2_reward), terminated, _ = step(-1, action)
+
+        #train policy1 and there is a state before p1_state for policy1
+        if transaction_p1_valid:
+            #add the reward for policy1 caused by policy2,
+            #if policy2 makes it terminated, the p1_state is a terminal state for policy1
+            state, prev_action, reward = transaction_p1
+            store1(state, prev_action, reward + p1_reward, None if terminated else p1_state)
+        if train_p2:
+            transaction_p2, transaction_p2_valid = (p2_state, action, p2_reward), True
+            if terminated:
+                store2(p2_state, action, p2_reward, None)
+        if terminated:
+            break
 
+    #update the q tables once the game ends
     if train_p1:
-        transaction_p1 = {}
+        policy1.flush_transactions()
     if train_p2:
-        transaction_p2 = {}
-    while True:
-        if info["on_move"] == 1:
-            action = policy1.decide(p1_state)
-            p2_state, (p1_reward, p2_reward), terminated, info = board.step(1, action)
+        policy2.flush_transactions()
 
-            #train policy2 and there is a state before p2_state for policy2
-            if train_p2 and "state" in transaction_p2:
-                #add the reward for policy2 caused by policy1
-                transaction_p2["reward"] += p2_reward
+    winner = p1_reward
+    return winner
 
-                #if policy1 makes it terminated, the p2_state is a terminal state for policy2
-                if not terminated:
-                    transaction_p2["next_state"] = p2_state
-                policy2.update_q_table(**transaction_p2)
-            if train_p1:
-                transaction_p1 = {"state": p1_state, "action": action, "reward": p1_reward, "next_state": None}
-                if terminated:
-                    policy1.update_q_table(**transaction_p1)
+def run_train_batched(board, policy1, policy2, num_games):
+    """
+    train any instances of QLearningPolicy in policy1 and policy2 for num_games games played side by side.
 
-        elif info["on_move"] == -1:
-            action = policy2.decide(p2_state)
-            p1_state, (p1_reward, p2_reward), terminated, info = board.step(-1, action)
+    All games advance one ply at a time on a stack of int8 boards, so each policy decides the moves
+    and stores the transactions of every game at once. The q tables are updated once all games end,
+    i.e. all games are played with the q tables at the start.
 
-            #train policy1 and there is a state before p1_state for policy1
-            #actually redundant
-            if train_p1 and "state" in transaction_p1:
-                #add the reward for policy1 caused by policy2
-                transaction_p1["reward"] += p1_reward
-
-                #if policy2 makes it terminated, the p1_state is a terminal state for policy1
-                if not terminated:
-                    transaction_p1["next_state"] = p1_state
-                policy1.update_q_table(**transaction_p1)
-            if train_p2:
-                transaction_p2 = {"state": p2_state, "action": action, "reward": p2_reward, "next_state": None}
-                if terminated:
-                    policy2.update_q_table(**transaction_p2)
+    Args:
+        board (TicTacToeBoard), the game board, giving the size and the length of line to win.
 
-        if terminated:
-            break            
+        policy1 (Policy): the policy for the first player, marker X.
 
-    winner = p1_reward
-    return winner
+        policy2 (Policy): the policy for the second player, marker O.
+
+        num_games (int): the number of games.
+
+    Returns:
+        winners (ndarray of int): for each game, 1 indicating the first Policy won,
+            -1 indicating the second Policy won,
+            or 0, means tie.
+    """
+    h, w = board.board.shape
+    boards = np.zeros((num_games, h, w), dtype=np.int8)
+    winners = np.zeros(num_games, dtype=np.int8)
+    policies = {1: policy1, -1: policy2}
+    train = {marker: isinstance(policy, QLearningPolicy) and policy.mode == "train" for marker, policy in policies.items()}
+    #the states and actions of the last move of each player, waiting for the response of the opponent
+    pending = {1: None, -1: None}
+
+    games = np.arange(num_games) #the games not yet ended
+    player = 1
+    for ply in range(h * w):
+        states = boards[games]
+        actions = policies[player].decide_batch(states)
+        boards.reshape(num_games, -1)[games, actions] = player
+        next_states = boards[games]
+        winners[games] = won = find_winners(next_states, board.win_len)
+        terminated = (won != 0) | (ply == h * w - 1)
+
+        #the move gives the reward to the opponent, and its next state unless the game ended
+        opponent = -player
+        if train[opponent] and pending[opponent] is not None:
+            policies[opponent].store_transactions(*pending[opponent], won * opponent, next_states, terminated)
+        if train[player]:
+            if terminated.any():
+                policies[player].store_transactions(
+                    states[terminated], actions[terminated], won[terminated] * player
+                )
+            pending[player] = states[~terminated], actions[~terminated]
+
+        games = games[~terminated]
+        if games.size == 0:
+            break
+        player = opponent
+
+    #update the q tables once the games end
+    for marker, policy in policies.items():
+        if train[marker]:
+            policy.flush_transactions()
+
+    return winners
+
+def _attach_shared_memory(name):
+    """
+    Attach to an existing shared memory without tracking it, as its creator is in charge of unlinking it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        #Python < 3.13 always tracks it
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+def _train_worker(board_size, win_len, hyperparameters, table_names, num_games, seed):
+    """
+    Self-play num_games games, starting from the q tables in shared memory,
+    with the random generators of the policies seeded by seed.
+
+    Returns:
+        updates (list of tuple of ndarray): for each policy, the (state_codes, action_codes, deltas)
+            of the Q-values changed by the games.
+    """
+    board = TicTacToeBoard(board_size, win_len)
+    #the tables come from shared memory, no need to load the saved ones
+    policies = [
+        QLearningPolicy(marker=marker, board_size=board_size, seed=policy_seed, autoload=False)
+        for marker, policy_seed in zip((1, -1), seed.spawn(2))
+    ]
+    initial_tables = []
+    for policy, name in zip(policies, table_names):
+        shm = _attach_shared_memory(name)
+        table = np.ndarray(policy.q_table.table.shape, dtype=policy.q_table.table.dtype, buffer=shm.buf)
+        policy.q_table.table[:] = table
+        initial_tables.append(table.copy())
+        del table
+        shm.close()
+        for key, val in hyperparameters.items():
+            setattr(policy, key, val)
+        policy.set_mode("train")
+
+    for _ in range(num_games):
+        run_train(board, *policies)
+
+    updates = []
+    for policy, initial_table in zip(policies, initial_tables):
+        delta = policy.q_table.table - initial_table
+        state_codes, action_codes = np.nonzero(delta)
+        updates.append((state_codes, action_codes, delta[state_codes, action_codes]))
+    return updates
+
+def run_train_parallel(pool, board, policy1, policy2, num_games, workers, seed=None):
+    """
+    train QLearningPolicy of policy1 and policy2 for num_games games by self-play, split among the workers of pool.
+
+    Every worker starts from the current q tables, shared with it through shared memory,
+    and plays its share of games on its own copy. Then the changes of the workers are merged into the q tables,
+    each Q-value moves by the average change of the workers which changed it.
+    Call it every few games to keep the copies of the workers from drifting apart.
+
+    Args:
+        pool (multiprocessing.Pool): the pool of worker processes.
+
+        board (TicTacToeBoard), the game board, giving the size and the length of line to win.
+
+        policy1 (QLearningPolicy): the policy for the first player, marker X.
+
+        policy2 (QLearningPolicy): the policy for the second player, marker O.
+
+        num_games (int): the number of games in total.
+
+        workers (int): the number of workers in pool.
+
+        seed (int or numpy.random.SeedSequence, optional): seeds the random generators of the workers,
+            each worker gets its own seed spawned from it. A SeedSequence spawns new seeds on every call.
+    """
+    assert isinstance(policy1, QLearningPolicy) and isinstance(policy2, QLearningPolicy), \
+        "Only QLearningPolicy can be trained in parallel!"
+    board_size, win_len = board.board.shape, board.win_len
+    hyperparameters = {key: getattr(policy1, key) for key in ("alpha", "gamma", "epsilon")}
+    policies = (policy1, policy2)
+    shms = [shared_memory.SharedMemory(create=True, size=policy.q_table.table.nbytes) for policy in policies]
+    try:
+        for policy, shm in zip(policies, shms):
+            table = np.ndarray(policy.q_table.table.shape, dtype=policy.q_table.table.dtype, buffer=shm.buf)
+            table[:] = policy.q_table.table
+            del table
+        table_names = [shm.name for shm in shms]
+        chunks = [num_games // workers + (k < num_games % workers) for k in range(workers)]
+        chunks = [chunk for chunk in chunks if chunk > 0]
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        results = pool.starmap(
+            _train_worker,
+            [
+                (board_size, win_len, hyperparameters, table_names, chunk, worker_seed)
+                for chunk, worker_seed in zip(chunks, seed.spawn(len(chunks)))
+            ],
+        )
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    for policy, updates in zip(policies, zip(*results)):
+        #average the deltas of each pair of state and action over the workers changing it
+        policy.add_to_q_table(*(np.concatenate(column) for column in zip(*updates)), average=True)
+
+def _positive_int(value):
+    """
+    argparse type of an int of at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not a positive int".format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive int".format(value))
+    return number
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Train Q-Learning agent")
     parser.add_argument("-n", "--num", type=int, required=True, help="The number of games for training")
+    parser.add_argument("-w", "--workers", type=_positive_int, default=1, help="The number of processes for training")
+    parser.add_argument("-b", "--batch", type=_positive_int, default=1,
+                        help="The number of games played side by side for training, ignored with several workers")
+    parser.add_argument("-s", "--sync", type=_positive_int, default=1000,
+                        help="The number of games between merging the q tables of the workers, at most 1000 "
+                             "as the q tables are also merged for the test every 1000 games")
+    parser.add_argument("--seed", type=int, default=None, help="The seed of the random generators")
     args = parser.parse_args()
+    if args.sync > 1000:
+        parser.error("--sync can be at most 1000, the q tables are merged for the test every 1000 games")
 
     board_size = 3, 3
     win_len = 3
 
+    seed = np.random.SeedSequence(args.seed)
+    p1_seed, p2_seed, test_p1_seed, test_p2_seed = seed.spawn(4)
+
     board = TicTacToeBoard(board_size, win_len)
-    p1 = QLearningPolicy(marker=1, board_size=board_size)
-    p2 = QLearningPolicy(marker=-1, board_size=board_size)
+    p1 = QLearningPolicy(marker=1, board_size=board_size, seed=p1_seed)
+    p2 = QLearningPolicy(marker=-1, board_size=board_size, seed=p2_seed)
 
     #define the tester
-    test_p1 = RandomPolicy(marker=1, board_size=board_size)
-    test_p2 = RandomPolicy(marker=-1, board_size=board_size)
+    test_p1 = RandomPolicy(marker=1, board_size=board_size, seed=test_p1_seed)
+    test_p2 = RandomPolicy(marker=-1, board_size=board_size, seed=test_p2_seed)
 
     N = args.num
-    hist_p1, hist_p2 = [], []
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    #the rates of p1_win, p2_win, tie of every test, from the view of the QLearningPolicy
+    hist_p1, hist_p2 = np.zeros((N // 1000, 3), dtype=np.float32), np.zeros((N // 1000, 3), dtype=np.float32)
+    trained = 0 #the games trained in parallel or in batches so far
     for i in range(1, N+1):
         #training part
         p1.set_mode("train")
         p2.set_mode("train")
-        run_train(board, p1, p2)
+        if pool is None and args.batch == 1:
+            run_train(board, p1, p2)
+        elif i % 1000 == 0 or i == N or (pool is not None and i % args.sync == 0):
+            #train the games since the last test or merge in parallel, or in batches
+            num_games, trained = i - trained, i
+            if pool is not None:
+                run_train_parallel(pool, board, p1, p2, num_games, args.workers, seed)
+            else:
+                for start in range(0, num_games, args.batch):
+                    run_train_batched(board, p1, p2, min(args.batch, num_games - start))
         if i % 1000 == 0:
             #test part
             p1.set_mode("eval")
             p2.set_mode("eval")
             print("game{:9}:".format(i))
-            results = [run_test(board, p1, test_p2) for i in range(100)]
+            results = np.fromiter((run_test(board, p1, test_p2) for _ in range(100)), dtype=np.int8, count=100)
 
-            win_rate = len([r for r in results if r == 1]) / len(results)
-            lose_rate = len([r for r in results if r == -1]) / len(results)
-            tie_rate = len([r for r in results if r == 0]) / len(results)
-            hist_p1.append((win_rate, lose_rate, tie_rate))
+            #counts of p1 lose, tie, p1 win
+            lose_rate, tie_rate, win_rate = np.bincount(results + 1, minlength=3) / results.size
+            hist_p1[i // 1000 - 1] = win_rate, lose_rate, tie_rate
             print("    QLearningPolicy vs RandomPolicy: p1_win: {:4.0%} p2_win: {:4.0%} tie: {:4.0%}".format(win_rate, lose_rate, tie_rate))
 
-            results = [run_test(board, test_p1, p2) for i in range(100)]
+            results = np.fromiter((run_test(board, test_p1, p2) for _ in range(100)), dtype=np.int8, count=100)
 
-            win_rate = len([r for r in results if r == 1]) / len(results)
-            lose_rate = len([r for r in results if r == -1]) / len(results)
-            tie_rate = len([r for r in results if r == 0]) / len(results)
-            hist_p2.append((lose_rate, win_rate, tie_rate))
+            lose_rate, tie_rate, win_rate = np.bincount(results + 1, minlength=3) / results.size
+            hist_p2[i // 1000 - 1] = lose_rate, win_rate, tie_rate
             print("    RandomPolicy vs QLearningPolicy: p1_win: {:4.0%} p2_win: {:4.0%} tie: {:4.0%}".format(win_rate, lose_rate, tie_rate))
             
             result = run_test(board, p1, p2)
             print("    Self play: {}".format("p1_win" if result == 1 else ("p2_win" if result == -1 else "tie")))
             print()
+    if pool is not None:
+        pool.close()
+        pool.join()
     p1.save()
     p2.save()
     
     # Plot part
     if len(hist_p1) > 100:
+        import matplotlib.pyplot as plt
+
         def running_average(arr, length):
-            ker = np.ones(length) / length
-            return np.convolve(arr, ker, mode="valid")
+            #differences of the running sum, in float64 to keep the rounding errors small
+            csum = np.concatenate(([0], np.cumsum(arr, dtype=np.float64)))
+            return (csum[length:] - csum[:-length]) / length
         
         def running_max(arr, length):
-            arr = [arr[i:i+length] for i in range(len(arr) - length + 1)]
-            arr = np.asarray(arr)
-            maxs = np.max(arr, -1)
+            windows = np.lib.stride_tricks.sliding_window_view(arr, length)
+            maxs = np.max(windows, -1)
             return maxs
 
         def running_min(arr, length):
-            arr = [arr[i:i+length] for i in range(len(arr) - length + 1)]
-            arr = np.asarray(arr)
-            mins = np.min(arr, -1)
+            windows = np.lib.stride_tricks.sliding_window_view(arr, length)
+            mins = np.min(windows, -1)
             return mins
 
         x = np.arange(len(hist_p1)) + 1
-        p1_win_a, p1_lose_a, p1_tie_a = [running_average(x, 100) for x in zip(*hist_p1)]
-        p1_win_max, p1_lose_max, p1_tie_max = [running_max(x, 100) for x in zip(*hist_p1)]
-        p1_win_min, p1_lose_min, p1_tie_min = [running_min(x, 100) for x in zip(*hist_p1)]
+        p1_win_a, p1_lose_a, p1_tie_a = [running_average(x, 100) for x in hist_p1.T]
+        p1_win_max, p1_lose_max, p1_tie_max = [running_max(x, 100) for x in hist_p1.T]
+        p1_win_min, p1_lose_min, p1_tie_min = [running_min(x, 100) for x in hist_p1.T]
 
         x = x[: len(p1_win_a)]
 
@@ -197,9 +421,9 @@ if __name__ == "__main__":
         plt.ylim(top=1, bottom=0)
         plt.legend()
 
-        p2_win_a, p2_lose_a, p2_tie_a = [running_average(x, 100) for x in zip(*hist_p2)]
-        p2_win_max, p2_lose_max, p2_tie_max = [running_max(x, 100) for x in zip(*hist_p2)]
-        p2_win_min, p2_lose_min, p2_tie_min = [running_min(x, 100) for x in zip(*hist_p2)]
+        p2_win_a, p2_lose_a, p2_tie_a = [running_average(x, 100) for x in hist_p2.T]
+        p2_win_max, p2_lose_max, p2_tie_max = [running_max(x, 100) for x in hist_p2.T]
+        p2_win_min, p2_lose_min, p2_tie_min = [running_min(x, 100) for x in hist_p2.T]
 
         #Plot for QLearningPolicy as the second player
         plt.figure()